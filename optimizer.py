@@ -0,0 +1,160 @@
+import math
+import random
+import time
+
+# Soft-constraint penalties per violation
+DEFAULT_WEIGHTS = {
+    "consecutive_subject": 3.0,  # same subject in back-to-back periods
+    "teacher_gap": 1.0,          # free period between two of a teacher's classes
+    "heavy_stacking": 2.0,       # heavy subjects beyond max_heavy_per_day on one day
+}
+
+# ---------- SIMULATED ANNEALING ----------
+# Improves a timetable grid {day: {period: (teacher_id, subject) or None}} by swapping
+# two cells at a time. Swaps that break a hard constraint are never made; the score
+# change of a swap is computed from the (at most two) days it touches only.
+#   external_busy: {(teacher_id, day, period)} booked by other sections
+#   unavailable:   {(teacher_id, day)} for absent teachers
+# Returns (best_grid, best_score).
+def optimize_grid(grid, external_busy, unavailable=(), weights=None, heavy_subjects=(),
+                  max_heavy_per_day=2, max_daily_load=5, max_subject_per_day=2,
+                  time_budget=2.0, max_iterations=None, start_temperature=2.0, seed=None):
+    if time_budget is None and max_iterations is None:
+        raise ValueError("optimize_grid needs a time_budget or max_iterations")
+    rng = random.Random(seed)
+    w = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    w_consec, w_gap, w_heavy = w["consecutive_subject"], w["teacher_gap"], w["heavy_stacking"]
+    heavy_subjects = set(heavy_subjects)
+    unavailable = set(unavailable)
+
+    days = list(grid)
+    periods = sorted(next(iter(grid.values()))) if grid else []
+    n_days, n_periods = len(days), len(periods)
+    if n_days == 0 or n_periods < 2:
+        return grid, 0.0
+    cells = [[grid[day][p] for p in periods] for day in days]
+
+    ext = {}
+    period_index = {p: i for i, p in enumerate(periods)}
+    day_index = {day: d for d, day in enumerate(days)}
+    for t_id, day, period_num in external_busy:
+        if day in day_index and period_num in period_index:
+            ext.setdefault((t_id, day_index[day]), set()).add(period_index[period_num])
+
+    load = {}
+    subj_count = [{} for _ in days]
+    for d, row in enumerate(cells):
+        for cell in row:
+            if cell:
+                t_id, subject = cell
+                load[(t_id, d)] = load.get((t_id, d), 0) + 1
+                subj_count[d][subject] = subj_count[d].get(subject, 0) + 1
+
+    def day_cost(d):
+        row = cells[d]
+        cost = 0.0
+        heavy = 0
+        teacher_periods = {}
+        prev = None
+        for i, cell in enumerate(row):
+            if cell:
+                t_id, subject = cell
+                if prev and prev[1] == subject:
+                    cost += w_consec
+                if subject in heavy_subjects:
+                    heavy += 1
+                teacher_periods.setdefault(t_id, []).append(i)
+            prev = cell
+        if heavy > max_heavy_per_day:
+            cost += w_heavy * (heavy - max_heavy_per_day)
+        for t_id, own in teacher_periods.items():
+            booked = ext.get((t_id, d))
+            if booked:
+                own = booked.union(own)
+                cost += w_gap * (max(own) - min(own) + 1 - len(own))
+            else:
+                cost += w_gap * (own[-1] - own[0] + 1 - len(own))
+        return cost
+
+    # Can cell move into (d, i) on another day while other leaves it?
+    def can_enter_day(cell, other, d, i):
+        t_id, subject = cell
+        if (t_id, days[d]) in unavailable or i in ext.get((t_id, d), ()):
+            return False
+        if load.get((t_id, d), 0) + 1 - (1 if other and other[0] == t_id else 0) > max_daily_load:
+            return False
+        if subj_count[d].get(subject, 0) + 1 - (1 if other and other[1] == subject else 0) > max_subject_per_day:
+            return False
+        return True
+
+    def move_counts(cell, src, dst):
+        t_id, subject = cell
+        load[(t_id, src)] -= 1
+        load[(t_id, dst)] = load.get((t_id, dst), 0) + 1
+        subj_count[src][subject] -= 1
+        subj_count[dst][subject] = subj_count[dst].get(subject, 0) + 1
+
+    def swap(d1, i1, d2, i2):
+        a, b = cells[d1][i1], cells[d2][i2]
+        cells[d1][i1], cells[d2][i2] = b, a
+        if d1 != d2:
+            if a:
+                move_counts(a, d1, d2)
+            if b:
+                move_counts(b, d2, d1)
+
+    day_costs = [day_cost(d) for d in range(n_days)]
+    score = sum(day_costs)
+    best_score, best_cells = score, [row[:] for row in cells]
+
+    deadline = time.perf_counter() + time_budget if time_budget is not None else None
+    total = max_iterations
+    iteration = 0
+    progress = 0.0
+    while True:
+        if total is not None and iteration >= total:
+            break
+        if iteration % 1024 == 0:
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                progress = max(progress, 1 - remaining / time_budget)
+            if total:
+                progress = max(progress, iteration / total)
+            temperature = start_temperature * (1 - progress) + 1e-9
+            if best_score == 0:
+                break
+        iteration += 1
+
+        d1, i1 = rng.randrange(n_days), rng.randrange(n_periods)
+        d2, i2 = rng.randrange(n_days), rng.randrange(n_periods)
+        a, b = cells[d1][i1], cells[d2][i2]
+        if a == b:
+            continue
+        if d1 == d2:
+            if (a and i2 in ext.get((a[0], d1), ())) or (b and i1 in ext.get((b[0], d1), ())):
+                continue
+        elif (a and not can_enter_day(a, b, d2, i2)) or (b and not can_enter_day(b, a, d1, i1)):
+            continue
+
+        swap(d1, i1, d2, i2)
+        new1 = day_cost(d1)
+        if d1 == d2:
+            delta = new1 - day_costs[d1]
+        else:
+            new2 = day_cost(d2)
+            delta = new1 + new2 - day_costs[d1] - day_costs[d2]
+
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            day_costs[d1] = new1
+            if d1 != d2:
+                day_costs[d2] = new2
+            score += delta
+            if score < best_score - 1e-9:
+                best_score, best_cells = score, [row[:] for row in cells]
+        else:
+            swap(d1, i1, d2, i2)
+
+    best_grid = {day: {p: best_cells[d][i] for i, p in enumerate(periods)} for d, day in enumerate(days)}
+    return best_grid, best_score
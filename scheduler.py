@@ -1,5 +1,10 @@
 import mysql.connector
+from mysql.connector import errorcode
+import html
+import logging
 import random
+import time
+import optimizer
 
 DB_CONFIG = {
     "host": "localhost",
@@ -10,6 +15,21 @@ DB_CONFIG = {
 
 WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
 
+PERIODS_PER_DAY = 8
+MAX_DAILY_LOAD = 5
+MAX_SUBJECT_PER_DAY = 2
+
+# Errors raised when another session booked the same teacher slot first
+# (unique key) or when InnoDB picked this transaction as a deadlock victim.
+RETRYABLE_ERRNOS = (errorcode.ER_DUP_ENTRY, errorcode.ER_LOCK_DEADLOCK)
+MAX_GENERATION_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+# Soft-constraint post-pass (see optimizer.optimize_grid)
+OPTIMIZE_TIME_BUDGET = 2.0
+MAX_HEAVY_PER_DAY = 2
+
 # ---------- DB CONNECTION ----------
 def get_connection(include_db=True):
     cfg = DB_CONFIG.copy()
@@ -70,6 +90,8 @@ def init_db():
             day_of_week VARCHAR(10),
             grade VARCHAR(50),
             section VARCHAR(10),
+            UNIQUE KEY uniq_teacher_slot (teacher_id, day_of_week, period_number),
+            INDEX idx_grade_section (grade, section),
             FOREIGN KEY (teacher_id) REFERENCES teachers(id) ON DELETE CASCADE
         )
     """)
@@ -79,9 +101,94 @@ def init_db():
     if not cur.fetchone():
         cur.execute("ALTER TABLE teacher_busy_periods ADD COLUMN section VARCHAR(10)")
 
+    # Double bookings removed by the migration below; kept until the section is regenerated
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dropped_bookings (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            grade VARCHAR(50),
+            section VARCHAR(10),
+            day_of_week VARCHAR(10),
+            period_number INT,
+            teacher_id INT,
+            dropped_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_grade_section (grade, section)
+        )
+    """)
+
+    # Tables created before these keys existed: a teacher can only be in one place per
+    # slot (concurrent generations rely on this), and clearing one section should not
+    # scan and lock the whole table (under REPEATABLE READ the delete still takes
+    # next-key locks around the section, so neighbours may wait or deadlock and retry).
+    cur.execute("SHOW INDEX FROM teacher_busy_periods WHERE Key_name='uniq_teacher_slot'")
+    if not cur.fetchall():
+        # Drop double bookings, keeping the oldest row, and record what was dropped
+        cur.execute("""
+            SELECT DISTINCT newer.id, newer.grade, newer.section, newer.day_of_week,
+                   newer.period_number, newer.teacher_id
+            FROM teacher_busy_periods newer
+            JOIN teacher_busy_periods older
+              ON newer.teacher_id = older.teacher_id
+             AND newer.day_of_week = older.day_of_week
+             AND newer.period_number = older.period_number
+             AND newer.id > older.id
+        """)
+        duplicates = cur.fetchall()
+        for row_id, grade, section, day, period_num, t_id in duplicates:
+            cur.execute("DELETE FROM teacher_busy_periods WHERE id=%s", (row_id,))
+            if cur.rowcount:
+                cur.execute("""
+                    INSERT INTO dropped_bookings (grade, section, day_of_week, period_number, teacher_id)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (grade, section, day, period_num, t_id))
+                logger.warning("Dropped double booking of teacher %s on %s period %s for %s-%s",
+                               t_id, day, period_num, grade, section)
+        add_key_if_missing(cur, """
+            ALTER TABLE teacher_busy_periods
+            ADD UNIQUE KEY uniq_teacher_slot (teacher_id, day_of_week, period_number)
+        """)
+    cur.execute("SHOW INDEX FROM teacher_busy_periods WHERE Key_name='idx_grade_section'")
+    if not cur.fetchall():
+        add_key_if_missing(cur, "ALTER TABLE teacher_busy_periods ADD INDEX idx_grade_section (grade, section)")
+
+    # Absences (periods is a comma-separated list of period numbers, NULL = whole day)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS teacher_absences (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            teacher_id INT,
+            absence_date DATE,
+            periods VARCHAR(50),
+            UNIQUE KEY uniq_teacher_date (teacher_id, absence_date),
+            INDEX idx_absence_date (absence_date),
+            FOREIGN KEY (teacher_id) REFERENCES teachers(id) ON DELETE CASCADE
+        )
+    """)
+    # Cover plans (one row per slot of an absent teacher, substitute NULL = uncovered)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cover_plans (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            absence_date DATE,
+            period_number INT,
+            grade VARCHAR(50),
+            section VARCHAR(10),
+            absent_teacher_id INT,
+            substitute_teacher_id INT,
+            INDEX idx_cover_date (absence_date),
+            FOREIGN KEY (absent_teacher_id) REFERENCES teachers(id) ON DELETE CASCADE,
+            FOREIGN KEY (substitute_teacher_id) REFERENCES teachers(id) ON DELETE SET NULL
+        )
+    """)
+
     conn.commit()
     conn.close()
 
+# Another session may add the same key between our SHOW INDEX and ALTER TABLE
+def add_key_if_missing(cur, alter_sql):
+    try:
+        cur.execute(alter_sql)
+    except mysql.connector.Error as e:
+        if e.errno != errorcode.ER_DUP_KEYNAME:
+            raise
+
 # ---------- COLOR HELPERS ----------
 def get_random_pastel():
     r = lambda: random.randint(150, 255)
@@ -148,60 +255,106 @@ def get_subjects_for_grade(grade):
     conn.close()
     return subs
 
-def clear_timetable_for_grade_section(grade, section):
+# Sections that lost bookings in the uniq_teacher_slot migration and need regenerating
+def get_sections_with_dropped_bookings():
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM teacher_busy_periods WHERE grade=%s AND section=%s", (grade, section))
-    conn.commit()
+    cur.execute("SELECT DISTINCT grade, section FROM dropped_bookings ORDER BY grade, section")
+    sections = cur.fetchall()
     conn.close()
+    return sections
 
-def get_day_assignments(day, grade, section):
+def get_all_sections():
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT tbp.period_number, t.teacher_name, t.subject
-        FROM teacher_busy_periods tbp
-        JOIN teachers t ON tbp.teacher_id = t.id
-        WHERE tbp.day_of_week=%s AND tbp.grade=%s AND tbp.section=%s
-        ORDER BY tbp.period_number
-    """, (day, grade, section))
-    rows = cur.fetchall()
+    cur.execute("SELECT grade, section_name FROM sections ORDER BY grade, section_name")
+    sections = cur.fetchall()
     conn.close()
-    return rows
-
-# ---------- TIMETABLE GENERATION ----------
-def generate_timetable(grade, section, absent_teachers_per_day):
-    teachers = get_teachers_for_grade(grade)
-    subjects = get_subjects_for_grade(grade)
-    if not teachers or not subjects:
-        return False
+    return sections
 
+def get_all_teachers():
     conn = get_connection()
     cur = conn.cursor()
+    cur.execute("SELECT id, teacher_name, subject FROM teachers ORDER BY teacher_name, id")
+    teachers = cur.fetchall()
+    conn.close()
+    return teachers
 
-    cur.execute("SELECT teacher_id, day_of_week, period_number FROM teacher_busy_periods")
-    busy_slots = set(cur.fetchall())
-
-    clear_timetable_for_grade_section(grade, section)
-
-    periods_per_day = 8
-    max_daily_load = 5
-    max_subject_per_day = 2
+# Whole weeks for many sections in one query: {(grade, section): [(day, period, teacher, subject)]}
+def get_section_week_assignments(grade_sections):
+    grade_sections = list(grade_sections)
+    weeks = {gs: [] for gs in grade_sections}
+    if not grade_sections:
+        return weeks
+    conn = get_connection()
+    cur = conn.cursor()
+    placeholders = ", ".join(["(%s, %s)"] * len(grade_sections))
+    cur.execute(f"""
+        SELECT tbp.grade, tbp.section, tbp.day_of_week, tbp.period_number, t.teacher_name, t.subject
+        FROM teacher_busy_periods tbp
+        JOIN teachers t ON tbp.teacher_id = t.id
+        WHERE (tbp.grade, tbp.section) IN ({placeholders})
+    """, [v for gs in grade_sections for v in gs])
+    for grade, section, day, period_num, teacher, subject in cur.fetchall():
+        weeks[(grade, section)].append((day, period_num, teacher, subject))
+    conn.close()
+    return weeks
+
+# Whole weeks for many teachers in one query: {teacher_id: [(day, period, "grade-section", subject)]}
+def get_teacher_week_assignments(teacher_ids):
+    teacher_ids = list(teacher_ids)
+    weeks = {t_id: [] for t_id in teacher_ids}
+    if not teacher_ids:
+        return weeks
+    conn = get_connection()
+    cur = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(teacher_ids))
+    cur.execute(f"""
+        SELECT tbp.teacher_id, tbp.day_of_week, tbp.period_number, tbp.grade, tbp.section, t.subject
+        FROM teacher_busy_periods tbp
+        JOIN teachers t ON tbp.teacher_id = t.id
+        WHERE tbp.teacher_id IN ({placeholders})
+    """, teacher_ids)
+    for t_id, day, period_num, grade, section, subject in cur.fetchall():
+        weeks[t_id].append((day, period_num, f"{grade}-{section}", subject))
+    conn.close()
+    return weeks
+
+# ---------- RENDER HELPERS ----------
+# One HTML table per week (days x periods) instead of a Streamlit element per cell.
+# assignments: iterable of (day, period, label, subject); label is shown above the subject.
+def render_week_html(assignments, subject_colors):
+    cells = {(day, period_num): (label, subject) for day, period_num, label, subject in assignments}
+    cell_style = "padding:6px;border-radius:5px;text-align:center;border:2px solid #ffffff;"
+    parts = ["<table style='width:100%;border-collapse:collapse;table-layout:fixed;'><tr><th></th>"]
+    parts.extend(f"<th style='text-align:center;'>P{p}</th>" for p in range(1, PERIODS_PER_DAY + 1))
+    parts.append("</tr>")
+    for day in WEEKDAYS:
+        parts.append(f"<tr><th style='text-align:left;'>{day}</th>")
+        for period_num in range(1, PERIODS_PER_DAY + 1):
+            cell = cells.get((day, period_num))
+            if cell:
+                label, subject = cell
+                color = subject_colors.get(subject, "#eeeeee")
+                text_color = get_contrasting_text_color(color)
+                parts.append(f"<td style='{cell_style}background-color:{color};color:{text_color};'>"
+                             f"{html.escape(str(label))}<br><b>{html.escape(str(subject))}</b></td>")
+            else:
+                parts.append(f"<td style='{cell_style}background-color:#f0f0f0;'>Free</td>")
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
 
-    teacher_daily_load = {tid: {day: 0 for day in WEEKDAYS} for tid, _, _ in teachers}
-    timetable_grid = {day: {p: None for p in range(1, periods_per_day + 1)} for day in WEEKDAYS}
+# ---------- TIMETABLE GENERATION ----------
+# Greedy placement into an in-memory grid {day: {period: (teacher_id, subject) or None}};
+# every slot booked here is also added to busy_slots.
+def place_subjects(subjects, subject_teacher_map, busy_slots, absent_teachers_per_day):
+    teacher_daily_load = {t_id: {day: 0 for day in WEEKDAYS} for t_id, _, _ in subject_teacher_map.values()}
+    timetable_grid = {day: {p: None for p in range(1, PERIODS_PER_DAY + 1)} for day in WEEKDAYS}
     subject_count_per_day = {day: {} for day in WEEKDAYS}
 
-    # FIX: Assign exactly one teacher per subject for this section
-    subject_teacher_map = {}
-    for subject, _ in subjects:
-        available_teachers = [t for t in teachers if t[2] == subject]
-        if available_teachers:
-            subject_teacher_map[subject] = random.choice(available_teachers)  # fixed teacher for this section
-
     subject_slots = []
     for subject, total_periods in subjects:
-        ensure_subject_color(subject)
         subject_slots.extend([subject] * total_periods)
     random.shuffle(subject_slots)
 
@@ -210,7 +363,7 @@ def generate_timetable(grade, section, absent_teachers_per_day):
         days = WEEKDAYS[:]
         random.shuffle(days)
         for day in days:
-            if subject_count_per_day[day].get(subject, 0) >= max_subject_per_day:
+            if subject_count_per_day[day].get(subject, 0) >= MAX_SUBJECT_PER_DAY:
                 continue
             periods = list(timetable_grid[day].keys())
             random.shuffle(periods)
@@ -225,7 +378,7 @@ def generate_timetable(grade, section, absent_teachers_per_day):
 
                 if t_name in absent_teachers_per_day.get(day, []):
                     continue
-                if teacher_daily_load[t_id][day] >= max_daily_load:
+                if teacher_daily_load[t_id][day] >= MAX_DAILY_LOAD:
                     continue
                 if (t_id, day, period_num) in busy_slots:
                     continue
@@ -239,15 +392,196 @@ def generate_timetable(grade, section, absent_teachers_per_day):
             if placed:
                 break
 
-    for day, periods in timetable_grid.items():
-        for period_num, assignment in periods.items():
-            if assignment:
-                t_id, subject = assignment
+    return timetable_grid
+
+def generate_timetable(grade, section, absent_teachers_per_day=None, optimize=False,
+                       time_budget=OPTIMIZE_TIME_BUDGET, weights=None, heavy_subjects=()):
+    absent_teachers_per_day = absent_teachers_per_day or {}
+    teachers = get_teachers_for_grade(grade)
+    subjects = get_subjects_for_grade(grade)
+    if not teachers or not subjects:
+        return False
+
+    # FIX: Assign exactly one teacher per subject for this section
+    subject_teacher_map = {}
+    for subject, _ in subjects:
+        ensure_subject_color(subject)
+        available_teachers = [t for t in teachers if t[2] == subject]
+        if available_teachers:
+            subject_teacher_map[subject] = random.choice(available_teachers)  # fixed teacher for this section
+    unavailable = {(t_id, day) for day in WEEKDAYS for t_id, t_name, _ in teachers
+                   if t_name in absent_teachers_per_day.get(day, [])}
+
+    # time_budget covers all attempts together; a retry only optimizes for what is left
+    deadline = time.monotonic() + time_budget
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        for attempt in range(1, MAX_GENERATION_ATTEMPTS + 1):
+            try:
+                # Read, clear and insert in one transaction so other sessions never see
+                # a half-written section, and a slot booked concurrently by another
+                # section trips uniq_teacher_slot instead of double-booking the teacher.
+                # The read takes no locks, so placement and optimization hold none either.
+                conn.start_transaction()
                 cur.execute("""
-                    INSERT INTO teacher_busy_periods (teacher_id, period_number, day_of_week, grade, section)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (t_id, period_num, day, grade, section))
+                    SELECT teacher_id, day_of_week, period_number FROM teacher_busy_periods
+                    WHERE NOT (grade <=> %s AND section <=> %s)
+                """, (grade, section))
+                busy_slots = set(cur.fetchall())
+                external_busy = frozenset(busy_slots)
+                cur.execute("SELECT DISTINCT day_of_week FROM teacher_busy_periods WHERE grade=%s AND section=%s",
+                            (grade, section))
+                changed_days = {r[0] for r in cur.fetchall()}
+
+                timetable_grid = place_subjects(subjects, subject_teacher_map, busy_slots,
+                                                absent_teachers_per_day)
+                remaining = deadline - time.monotonic()
+                if optimize and remaining > 0:
+                    timetable_grid, _ = optimizer.optimize_grid(
+                        timetable_grid, external_busy, unavailable, weights=weights,
+                        heavy_subjects=heavy_subjects, max_heavy_per_day=MAX_HEAVY_PER_DAY,
+                        max_daily_load=MAX_DAILY_LOAD, max_subject_per_day=MAX_SUBJECT_PER_DAY,
+                        time_budget=remaining)
+
+                cur.execute("DELETE FROM teacher_busy_periods WHERE grade=%s AND section=%s", (grade, section))
+                cur.execute("DELETE FROM dropped_bookings WHERE grade=%s AND section=%s", (grade, section))
+                for day, periods in timetable_grid.items():
+                    for period_num, assignment in periods.items():
+                        if assignment:
+                            t_id, subject = assignment
+                            cur.execute("""
+                                INSERT INTO teacher_busy_periods (teacher_id, period_number, day_of_week, grade, section)
+                                VALUES (%s, %s, %s, %s, %s)
+                            """, (t_id, period_num, day, grade, section))
+                conn.commit()
+                changed_days |= {day for day, periods in timetable_grid.items() if any(periods.values())}
+                break
+            except mysql.connector.Error as e:
+                conn.rollback()
+                if e.errno not in RETRYABLE_ERRNOS or attempt == MAX_GENERATION_ATTEMPTS:
+                    raise
+                # Another section took one of our slots; re-read busy slots and place again
+    finally:
+        conn.close()
+
+    # Stored cover plans for the weekdays this section used or now uses point at old slots
+    refresh_cover_plans(changed_days)
+    return True
 
+# ---------- ABSENCES & COVER PLANS ----------
+def save_absences_for_date(absence_date, absences):
+    # absences: {teacher_id: [period numbers] or None for the whole day}; replaces the date's list
+    conn = get_connection()
+    cur = conn.cursor()
+    conn.start_transaction()
+    cur.execute("DELETE FROM teacher_absences WHERE absence_date=%s", (absence_date,))
+    for t_id, periods in absences.items():
+        periods_str = ",".join(str(p) for p in sorted(periods)) if periods else None
+        cur.execute("INSERT INTO teacher_absences (teacher_id, absence_date, periods) VALUES (%s, %s, %s)",
+                    (t_id, absence_date, periods_str))
     conn.commit()
     conn.close()
-    return True
+
+def get_absences_for_date(absence_date):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT teacher_id, periods FROM teacher_absences WHERE absence_date=%s", (absence_date,))
+    absences = {t_id: ([int(p) for p in periods.split(",")] if periods else None)
+                for t_id, periods in cur.fetchall()}
+    conn.close()
+    return absences
+
+def compute_cover_plan(absence_date):
+    # Runs once per date for the whole school: every slot of an absent teacher gets the
+    # best free substitute (same subject, then teaches the grade, then least loaded).
+    absences = get_absences_for_date(absence_date)
+    day = WEEKDAYS[absence_date.weekday()] if absence_date.weekday() < len(WEEKDAYS) else None
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, teacher_name, subject, grades FROM teachers")
+    teachers = {t_id: (subject, (grades or "").split(",")) for t_id, _, subject, grades in cur.fetchall()}
+    busy_rows = []
+    if day in WEEKDAYS:
+        cur.execute("""
+            SELECT teacher_id, period_number, grade, section
+            FROM teacher_busy_periods WHERE day_of_week=%s
+        """, (day,))
+        busy_rows = cur.fetchall()
+
+    busy = {(t_id, period_num) for t_id, period_num, _, _ in busy_rows}
+    daily_load = {t_id: 0 for t_id in teachers}
+    for t_id, _, _, _ in busy_rows:
+        daily_load[t_id] = daily_load.get(t_id, 0) + 1
+
+    def is_absent(t_id, period_num):
+        return t_id in absences and (absences[t_id] is None or period_num in absences[t_id])
+
+    affected = sorted((row for row in busy_rows if is_absent(row[0], row[1])), key=lambda r: (r[1], r[2], r[3]))
+    plan = []
+    for absent_id, period_num, grade, section in affected:
+        subject = teachers.get(absent_id, (None, []))[0]
+        candidates = [t_id for t_id in teachers
+                      if not is_absent(t_id, period_num)
+                      and (t_id, period_num) not in busy
+                      and daily_load[t_id] < MAX_DAILY_LOAD]
+        substitute_id = None
+        if candidates:
+            substitute_id = min(candidates, key=lambda t_id: (teachers[t_id][0] != subject,
+                                                              grade not in teachers[t_id][1],
+                                                              daily_load[t_id], t_id))
+            busy.add((substitute_id, period_num))
+            daily_load[substitute_id] += 1
+        plan.append((absence_date, period_num, grade, section, absent_id, substitute_id))
+
+    # The reads above already opened a transaction (autocommit is off); the replace
+    # below joins it and lands atomically at commit.
+    cur.execute("DELETE FROM cover_plans WHERE absence_date=%s", (absence_date,))
+    if plan:
+        cur.executemany("""
+            INSERT INTO cover_plans (absence_date, period_number, grade, section, absent_teacher_id, substitute_teacher_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, plan)
+    conn.commit()
+    conn.close()
+    return len(plan)
+
+# Recompute plans from today on, optionally only for dates falling on the given weekdays;
+# call after the timetable or the teacher list changes. The change itself is already
+# committed, so failures are logged rather than raised.
+def refresh_cover_plans(days=None):
+    refreshed = 0
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT absence_date FROM teacher_absences WHERE absence_date >= CURDATE()
+            UNION
+            SELECT absence_date FROM cover_plans WHERE absence_date >= CURDATE()
+        """)
+        dates = [r[0] for r in cur.fetchall()]
+        conn.close()
+        if days is not None:
+            dates = [d for d in dates if d.weekday() < len(WEEKDAYS) and WEEKDAYS[d.weekday()] in days]
+        for absence_date in dates:
+            compute_cover_plan(absence_date)
+            refreshed += 1
+    except mysql.connector.Error:
+        logger.exception("Refreshing cover plans failed; recompute them from the Absentees tab")
+    return refreshed
+
+def get_cover_plan(absence_date):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT cp.period_number, cp.grade, cp.section, a.teacher_name, a.subject, s.teacher_name
+        FROM cover_plans cp
+        JOIN teachers a ON cp.absent_teacher_id = a.id
+        LEFT JOIN teachers s ON cp.substitute_teacher_id = s.id
+        WHERE cp.absence_date=%s
+        ORDER BY cp.period_number, cp.grade, cp.section
+    """, (absence_date,))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
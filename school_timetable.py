@@ -1,12 +1,20 @@
 import streamlit as st
 import pandas as pd
+import datetime
+import html
 import scheduler
+import optimizer
 
 scheduler.init_db()
 
 st.set_page_config(page_title="School Timetable", layout="wide")
 
-tabs = st.tabs(["📥 Setup", "🚫 Absentees", "📅 Timetable"])
+dropped_sections = scheduler.get_sections_with_dropped_bookings()
+if dropped_sections:
+    st.warning("Removed double bookings found while upgrading the database; regenerate these sections: "
+               + ", ".join(f"{g}-{s}" for g, s in dropped_sections))
+
+tabs = st.tabs(["📥 Setup", "🚫 Absentees", "📅 Timetable", "🏫 Overview"])
 
 # ---------- PAGE 1: SETUP ----------
 with tabs[0]:
@@ -21,6 +29,7 @@ with tabs[0]:
                         (row["teacher_name"], row["subject"], row["grades"]))
         conn.commit()
         conn.close()
+        scheduler.refresh_cover_plans()
         st.success("Teachers uploaded!")
 
     st.subheader("Add Teacher Manually")
@@ -36,6 +45,7 @@ with tabs[0]:
                         (t_name, t_subject, t_grades))
             conn.commit()
             conn.close()
+            scheduler.refresh_cover_plans()
             st.success(f"Added {t_name}")
 
     st.markdown("---")
@@ -82,18 +92,42 @@ with tabs[0]:
             st.success(f"Added Section {sec_name} to Grade {sec_grade}")
 
 # ---------- PAGE 2: ABSENTEES ----------
-absent_teachers = {}
 with tabs[1]:
     st.header("Mark Absent Teachers")
     conn = scheduler.get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT DISTINCT teacher_name FROM teachers")
-    all_teachers = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT id, teacher_name FROM teachers ORDER BY teacher_name")
+    all_teachers = dict(cur.fetchall())
     conn.close()
 
-    for day in scheduler.WEEKDAYS:
-        absent = st.multiselect(f"{day} Absentees", all_teachers)
-        absent_teachers[day] = absent
+    absence_date = st.date_input("Date", value=datetime.date.today())
+    saved_absences = scheduler.get_absences_for_date(absence_date)
+    absent_ids = st.multiselect("Absent Teachers", list(all_teachers),
+                                default=[t_id for t_id in saved_absences if t_id in all_teachers],
+                                format_func=all_teachers.get, key=f"absent_{absence_date}")
+    absences = {}
+    for t_id in absent_ids:
+        periods = st.multiselect(f"{all_teachers[t_id]} absent periods (empty = whole day)",
+                                 list(range(1, scheduler.PERIODS_PER_DAY + 1)),
+                                 default=saved_absences.get(t_id) or [],
+                                 key=f"absent_periods_{absence_date}_{t_id}")
+        absences[t_id] = periods or None
+    if st.button("Save Absences"):
+        scheduler.save_absences_for_date(absence_date, absences)
+        covered = scheduler.compute_cover_plan(absence_date)
+        st.success(f"Saved absences and planned cover for {covered} periods")
+
+    if st.button("Recompute Cover Plan"):
+        scheduler.compute_cover_plan(absence_date)
+
+    st.subheader(f"Cover Plan - {absence_date:%A %d %b %Y}")
+    plan = scheduler.get_cover_plan(absence_date)
+    if plan:
+        st.dataframe(pd.DataFrame(plan, columns=["Period", "Grade", "Section", "Absent Teacher",
+                                                 "Subject", "Substitute"]).fillna("Uncovered"),
+                     hide_index=True)
+    else:
+        st.info("No cover needed for this date.")
 
 # ---------- PAGE 3: TIMETABLE ----------
 with tabs[2]:
@@ -110,10 +144,29 @@ with tabs[2]:
         if sections:
             selected_section = st.selectbox("Select Section", sections)
 
+            with st.expander("Optimize Soft Constraints"):
+                optimize = st.checkbox("Improve timetable after generation")
+                time_budget = st.slider("Time budget (seconds)", 0.5, 30.0, scheduler.OPTIMIZE_TIME_BUDGET)
+                grade_subjects = [s for s, _ in scheduler.get_subjects_for_grade(selected_grade)]
+                heavy_subjects = st.multiselect("Heavy subjects (spread across the week)", grade_subjects)
+                weights = {
+                    "consecutive_subject": st.number_input(
+                        "Weight: same subject back-to-back", 0.0, 100.0,
+                        optimizer.DEFAULT_WEIGHTS["consecutive_subject"]),
+                    "teacher_gap": st.number_input(
+                        "Weight: gaps in a teacher's day", 0.0, 100.0,
+                        optimizer.DEFAULT_WEIGHTS["teacher_gap"]),
+                    "heavy_stacking": st.number_input(
+                        "Weight: heavy subjects stacked on one day", 0.0, 100.0,
+                        optimizer.DEFAULT_WEIGHTS["heavy_stacking"]),
+                }
+
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("Auto Generate Timetable"):
-                    success = scheduler.generate_timetable(selected_grade, selected_section, absent_teachers)
+                    success = scheduler.generate_timetable(selected_grade, selected_section, optimize=optimize,
+                                                             time_budget=time_budget, weights=weights,
+                                                             heavy_subjects=heavy_subjects)
                     if success:
                         st.success("Timetable generated!")
                         st.rerun()
@@ -122,28 +175,45 @@ with tabs[2]:
                     st.info("Showing existing timetable...")
 
             subject_colors = scheduler.get_subject_colors()
-            for day in scheduler.WEEKDAYS:
-                st.subheader(f"{day} - Grade {selected_grade} Section {selected_section}")
-                assignments = scheduler.get_day_assignments(day, selected_grade, selected_section)
-                cols = st.columns(8)
-                for i, col in enumerate(cols, start=1):
-                    match = next((a for a in assignments if a[0] == i), None)
-                    if match:
-                        _, teacher, subject = match
-                        color = subject_colors.get(subject, "#eeeeee")
-                        text_color = scheduler.get_contrasting_text_color(color)
-                        col.markdown(
-                            f"<div style='background-color:{color};color:{text_color};"
-                            f"padding:8px;border-radius:5px;text-align:center;'>"
-                            f"{teacher}<br><b>{subject}</b></div>",
-                            unsafe_allow_html=True
-                        )
-                    else:
-                        col.markdown(
-                            "<div style='background-color:#f0f0f0;padding:8px;border-radius:5px;text-align:center;'>Free</div>",
-                            unsafe_allow_html=True
-                        )
+            st.subheader(f"Grade {selected_grade} Section {selected_section}")
+            week = scheduler.get_section_week_assignments([(selected_grade, selected_section)])
+            st.markdown(scheduler.render_week_html(week[(selected_grade, selected_section)], subject_colors),
+                        unsafe_allow_html=True)
         else:
             st.warning("No sections found for this grade. Please add sections in Setup.")
     else:
         st.warning("No grades found. Please add subjects first.")
+
+# ---------- PAGE 4: OVERVIEW ----------
+with tabs[3]:
+    st.header("Whole-School Overview")
+    view = st.radio("Show", ["Sections", "Teachers"], horizontal=True)
+    if view == "Sections":
+        items = [((g, s), f"Grade {g} Section {s}") for g, s in scheduler.get_all_sections()]
+    else:
+        items = [(t_id, f"{t_name} ({t_subject})") for t_id, t_name, t_subject in scheduler.get_all_teachers()]
+
+    if items:
+        col1, col2 = st.columns(2)
+        with col1:
+            page_size = st.selectbox("Per page", [10, 25, 50], key="overview_page_size")
+        num_pages = (len(items) + page_size - 1) // page_size
+        with col2:
+            page = st.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1,
+                                   key=f"overview_page_{view}_{page_size}")
+        page_items = items[(page - 1) * page_size:page * page_size]
+
+        # One query and one element for the whole page, however many weeks it holds
+        keys = [key for key, _ in page_items]
+        if view == "Sections":
+            weeks = scheduler.get_section_week_assignments(keys)
+        else:
+            weeks = scheduler.get_teacher_week_assignments(keys)
+        subject_colors = scheduler.get_subject_colors()
+        st.markdown(
+            "".join(f"<h4>{html.escape(title)}</h4>{scheduler.render_week_html(weeks[key], subject_colors)}"
+                    for key, title in page_items),
+            unsafe_allow_html=True
+        )
+    else:
+        st.warning(f"No {view.lower()} found. Please add them in Setup.")